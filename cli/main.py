@@ -1,20 +1,18 @@
 import os
 import time
+import functools
 import shutil
-import json
+import glob
+import tempfile
 import re
-import pickle
 import typer
-import docker
-import matplotlib
-import matplotlib.pyplot as plt
-import pandas as pd
+import orjson
+from concurrent.futures import ThreadPoolExecutor
 from ast import literal_eval
-from typing import Optional, Any
+from typing import Optional, Any, TYPE_CHECKING
 from typing_extensions import Annotated
-from rich import print
+from rich.console import Console
 from rich.panel import Panel
-from tabulate import tabulate
 from datakitpy.datakit import (
     ExecutionError,
     ResourceError,
@@ -37,37 +35,114 @@ from datakitpy.datakit import (
     RELATIONSHIPS_FILE,
     VIEW_ARTEFACTS_DIR,
 )
-from datakitpy.helpers import find_by_name, find
+from datakitpy.helpers import find
 
+if TYPE_CHECKING:
+    import docker
 
-app = typer.Typer(no_args_is_help=True)
 
+app = typer.Typer(no_args_is_help=True)
 
-client = docker.from_env()
+# Share a single console for all output rather than going through
+# rich.print, which looks up the global console on every call
+console = Console()
+print = console.print
 
 
 # Assume we are always at the datakit root
 # TODO: Validate we actually are, and that this is a datakit
 DATAKIT_PATH = os.getcwd()  # Root datakit path
-CONFIG_FILE = f"{DATAKIT_PATH}/.datakit"
+CONFIG_FILE = os.path.join(DATAKIT_PATH, ".datakit")
 RUN_EXTENSION = ".run"
+MAX_IO_WORKERS = 8  # Thread pool size for concurrent file operations
+
+# Run names have the format [algorithm].[name]
+RUN_NAME_PATTERN = re.compile(r"^([a-zA-Z0-9_]+)\.([a-zA-Z0-9_]+)$")
+# Plain integers and floats, e.g. 42, -1.5, 2e-3
+NUMBER_PATTERN = re.compile(
+    r"^-?(0|[1-9]\d*)(\.\d+)?([eE][+-]?\d+)?$", re.ASCII
+)
+# Table references have the format [resource].[primary key].[column]
+TABLE_REF_PATTERN = re.compile(
+    r"^([a-zA-Z0-9_]+)\.([a-zA-Z0-9_]+)\.([a-zA-Z0-9_]+)$"
+)
 
 
 # Helpers
 
 
-def dumb_str_to_type(value) -> Any:
+def dumb_str_to_type(value: str) -> Any:
     """Parse a string to any Python type"""
     # Stupid workaround for Typer not supporting Union types :<
+
+    # Handle common cases directly before falling back to literal_eval,
+    # which has to build an AST for every input
+    if value.lower() == "true":
+        return True
+    elif value.lower() == "false":
+        return False
+    elif number := NUMBER_PATTERN.match(value):
+        # No fraction or exponent means an integer
+        if number.group(2) is None and number.group(3) is None:
+            return int(value)
+        return float(value)
+    elif value.isidentifier():
+        # Plain words can only be None or a string
+        return None if value == "None" else value
+
     try:
         return literal_eval(value)
-    except ValueError:
-        if value.lower() == "true":
-            return True
-        elif value.lower() == "false":
-            return False
-        else:
-            return value
+    except (ValueError, SyntaxError):
+        return value
+
+
+def load_json(path: str) -> Any:
+    """Load a JSON file"""
+    with open(path, "rb") as f:
+        return orjson.loads(f.read())
+
+
+def write_json(path: str, obj: Any) -> None:
+    """Atomically write an object to a JSON file"""
+    # Write to a uniquely named file in the same directory and move it into
+    # place, so interrupted or concurrent writes never leave a partial file
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix=os.path.basename(path) + "."
+    )
+
+    try:
+        # mkstemp creates the file as owner-only, so keep the mode of the
+        # file being replaced, or use the umask default for a new file
+        try:
+            mode = os.stat(path).st_mode & 0o777
+        except FileNotFoundError:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+
+        os.fchmod(fd, mode)
+
+        with os.fdopen(fd, "wb") as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, path)
+    except BaseException:
+        # Don't leave a stale temporary file behind
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+@functools.lru_cache(maxsize=1)
+def get_docker_client() -> "docker.DockerClient":
+    """Return a Docker client, connecting to the daemon on first use"""
+    import docker
+
+    return docker.from_env()
 
 
 def get_default_algorithm() -> str:
@@ -75,13 +150,12 @@ def get_default_algorithm() -> str:
     return load_datakit_configuration(base_path=DATAKIT_PATH)["algorithms"][0]
 
 
-def load_config():
+def load_config() -> dict:
     """Load CLI configuration file"""
-    with open(CONFIG_FILE, "r") as f:
-        return json.load(f)
+    return load_json(CONFIG_FILE)
 
 
-def get_active_run():
+def get_active_run() -> str:
     try:
         return load_config()["run"]
     except FileNotFoundError:
@@ -89,89 +163,183 @@ def get_active_run():
         exit(1)
 
 
-def write_config(run_name):
+def write_config(run_name: str) -> None:
     """Write updated CLI configuration file"""
-    with open(CONFIG_FILE, "w") as f:
-        json.dump({"run": run_name}, f, indent=2)
+    write_json(CONFIG_FILE, {"run": run_name})
 
 
-def run_exists(run_name):
+def run_exists(run_name: str) -> bool:
     """Check if specified run exists"""
     run_dir = RUN_DIR.format(base_path=DATAKIT_PATH, run_name=run_name)
     return os.path.exists(run_dir) and os.path.isdir(run_dir)
 
 
-def get_full_run_name(run_name):
+def get_full_run_name(
+    run_name: Optional[str], *, validate_algorithm: bool = True
+) -> str:
     """Validate and return full run name"""
     if run_name is not None:
+        datakit_algorithms = None
+
         # Check the run_name matches the pattern [algorithm].[name] or
         # [algorithm]
-        pattern = re.compile(r"^([a-zA-Z0-9_]+)\.([a-zA-Z0-9_]+)$")
+        if not RUN_NAME_PATTERN.match(run_name):
+            datakit_algorithms = load_datakit_configuration(
+                base_path=DATAKIT_PATH
+            )["algorithms"]
 
-        algorithms = load_datakit_configuration()["algorithms"]
+            if run_name not in datakit_algorithms:
+                print(f'[red]"{run_name}" is not a valid run name[/red]')
+                print(
+                    "[red]Run names must match the format: "
+                    r"\[algorithm].\[name][/red]"
+                )
+                print(
+                    "[red]Did you forget to add your algorithm to "
+                    "datakit.json?[/red]"
+                )
+                exit(1)
 
-        if not pattern.match(run_name) and run_name not in algorithms:
-            print(f'[red]"{run_name}" is not a valid run name[/red]')
-            print(
-                "[red]Run names must match the format: "
-                r"\[algorithm].\[name][/red]"
-            )
-            print(
-                "[red]Did you forget to add your algorithm to "
-                "datakit.json?[/red]"
-            )
-            exit(1)
+        # Callers acting on an existing run can skip this, as the algorithm
+        # was validated when the run was initialised
+        if validate_algorithm:
+            algorithm_name = get_algorithm_name(run_name)
 
-        algorithm_name = get_algorithm_name(run_name)
-        datakit_algorithms = load_datakit_configuration(
-            base_path=DATAKIT_PATH
-        )["algorithms"]
+            if datakit_algorithms is None:
+                datakit_algorithms = load_datakit_configuration(
+                    base_path=DATAKIT_PATH
+                )["algorithms"]
 
-        if get_algorithm_name(run_name) not in datakit_algorithms:
-            print(
-                f'[red]"{algorithm_name}" is not a valid datakit '
-                "algorithm[/red]"
-            )
-            print(
-                "[red]Available datakit algorithms: "
-                f"{datakit_algorithms}[/red]"
-            )
-            exit(1)
+            if algorithm_name not in datakit_algorithms:
+                print(
+                    f'[red]"{algorithm_name}" is not a valid datakit '
+                    "algorithm[/red]"
+                )
+                print(
+                    "[red]Available datakit algorithms: "
+                    f"{datakit_algorithms}[/red]"
+                )
+                exit(1)
 
         return run_name + RUN_EXTENSION
     else:
         return get_default_algorithm() + RUN_EXTENSION
 
 
-def execute_relationship(run_name: str, variable_name: str) -> None:
+def init_resources(run_name: str, resources: list[tuple[str, str]]) -> None:
+    """Initialise (kind, resource name) resources for a run concurrently"""
+    # A resource can back both an input and an output, so initialise each
+    # one only once rather than writing the same file from two threads
+    kinds = {}
+    for kind, resource_name in resources:
+        kinds.setdefault(resource_name, kind)
+
+    if not kinds:
+        return
+
+    max_workers = min(MAX_IO_WORKERS, len(kinds))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            (
+                kind,
+                resource_name,
+                executor.submit(
+                    init_resource,
+                    run_name=run_name,
+                    resource_name=resource_name,
+                    base_path=DATAKIT_PATH,
+                ),
+            )
+            for resource_name, kind in kinds.items()
+        ]
+
+        # Report in signature order. Calling result() raises any
+        # initialisation error here
+        for kind, resource_name, future in futures:
+            future.result()
+            print(
+                f"[bold]=>[/bold] Generated {kind} resource: {resource_name}"
+            )
+
+
+def print_resource(resource) -> None:
+    """Print tabular data resource data as a table"""
+    from tabulate import tabulate
+
+    print(
+        tabulate(
+            resource.to_dict()["data"],
+            headers="keys",
+            tablefmt="rounded_grid",
+        )
+    )
+
+
+def print_value(variable_name: str, value: Any) -> None:
+    """Print a simple variable value"""
+    print(
+        Panel(
+            str(value),
+            title=f"{variable_name}",
+            expand=False,
+        )
+    )
+
+
+def index_variables(run: dict) -> dict:
+    """Map variable names to variables in a run configuration"""
+    # Values are the run configuration's own dicts, so changes made through
+    # the index are reflected in the run configuration
+    return {
+        variable["name"]: variable
+        for kind in ("inputs", "outputs")
+        for variable in run["data"][kind]
+    }
+
+
+def execute_relationship(
+    run_name: str,
+    variable_name: str,
+    run_config: Optional[dict] = None,
+) -> None:
     """Execute any relationships applied to the given source variable"""
-    # Load run configuration for modification
-    run = load_run_configuration(run_name)
+    # Load run configuration for modification, unless the caller already
+    # holds it, in which case it is modified in place
+    if run_config is None:
+        run = load_run_configuration(run_name)
+    else:
+        run = run_config
 
     print(
         f"[bold]=>[/bold] Executing relationship for variable {variable_name}"
     )
 
     # Load associated relationship
+    # The run configuration already records its algorithm, so there is no
+    # need to parse it out of the run name
     try:
-        with open(
+        relationships = load_json(
             RELATIONSHIPS_FILE.format(
                 base_path=DATAKIT_PATH,
-                algorithm_name=get_algorithm_name(run_name),
-            ),
-            "r",
-        ) as f:
-            relationship = find(
-                json.load(f)["relationships"], "source", variable_name
+                algorithm_name=run["algorithm"],
             )
+        )["relationships"]
     except FileNotFoundError:
         # No relationships to execute, return
         return
 
+    relationship = find(relationships, "source", variable_name)
+
     if relationship is None:
         # No relationship for specified variable found, return
         return
 
+    # Look up variables in the already loaded run configuration rather than
+    # re-reading it from disk for every rule and target
+    variables = index_variables(run)
+    source_variable = variables[variable_name]
+
     # Apply relationship rules
     for rule in relationship["rules"]:
         if rule["type"] == "change":
@@ -199,25 +367,14 @@ def execute_relationship(run_name: str, variable_name: str) -> None:
         elif rule["type"] == "value":
             # Check if this rule applies to current run configuration state
 
-            # Get source variable value
-            value = load_variable(
-                run_name=run_name,
-                variable_name=variable_name,
-                base_path=DATAKIT_PATH,
-            )["value"]
-
             # If the source variable value matches the rule value, execute
             # the relationship
-            if value in rule["values"]:
+            if source_variable["value"] in rule["values"]:
                 for target in rule["targets"]:
+                    target_variable = variables[target["name"]]
+
                     if "disabled" in target:
                         # Set target variable disabled value
-                        target_variable = load_variable(
-                            run_name=run_name,
-                            variable_name=target["name"],
-                            base_path=DATAKIT_PATH,
-                        )
-
                         target_variable["disabled"] = target["disabled"]
 
                     if target["type"] == "resource":
@@ -250,11 +407,6 @@ def execute_relationship(run_name: str, variable_name: str) -> None:
                         )
                     elif target["type"] == "value":
                         # Set target variable value
-                        target_variable = find_by_name(
-                            run["data"]["inputs"] + run["data"]["outputs"],
-                            target["name"],
-                        )
-
                         if "value" in target:
                             print(
                                 f" [bold]*[/bold] Setting {target['name']} "
@@ -313,8 +465,8 @@ def init(
 
     # Create run directory
     run_dir = RUN_DIR.format(base_path=DATAKIT_PATH, run_name=run_name)
-    os.makedirs(f"{run_dir}/resources")
-    os.makedirs(f"{run_dir}/views")
+    for subdir in ("resources", "views"):
+        os.makedirs(os.path.join(run_dir, subdir), exist_ok=True)
     print(f"[bold]=>[/bold] Created run directory: {run_dir}")
 
     algorithm_name = get_algorithm_name(run_name)
@@ -333,48 +485,25 @@ def init(
         },
     }
 
-    # Create run configuration and initialise resources
-    for variable in algorithm["signature"]["inputs"]:
-        # Add variable defaults to run configuration
-        run["data"]["inputs"].append(
-            {
-                "name": variable["name"],
-                **variable["default"],
-            }
-        )
+    # Create run configuration and collect resources to initialise
+    resources = []
 
-        # Initialise associated resources
-        if variable["type"] == "resource":
-            resource_name = variable["default"]["resource"]
-
-            init_resource(
-                run_name=run["name"],
-                resource_name=resource_name,
-                base_path=DATAKIT_PATH,
+    for kind in ("inputs", "outputs"):
+        for variable in algorithm["signature"][kind]:
+            # Add variable defaults to run configuration
+            run["data"][kind].append(
+                {
+                    "name": variable["name"],
+                    **variable["default"],
+                }
             )
 
-            print(f"[bold]=>[/bold] Generated input resource: {resource_name}")
+            # Collect associated resources for initialisation
+            if variable["type"] == "resource":
+                resources.append((kind[:-1], variable["default"]["resource"]))
 
-    for variable in algorithm["signature"]["outputs"]:
-        # Add variable defaults to run configuration
-        run["data"]["outputs"].append(
-            {
-                "name": variable["name"],
-                **variable["default"],
-            }
-        )
-
-        # Initialise associated resources
-        if variable["type"] == "resource":
-            resource_name = variable["default"]["resource"]
-
-            init_resource(
-                run_name=run["name"],
-                resource_name=resource_name,
-                base_path=DATAKIT_PATH,
-            )
-
-            print(f"[bold]=>[/bold] Generated input resource: {resource_name}")
+    # Initialise associated resources
+    init_resources(run_name, resources)
 
     # Write generated configuration
     write_run_configuration(run, base_path=DATAKIT_PATH)
@@ -398,7 +527,9 @@ def set_run(
     ] = None,
 ) -> None:
     """Set the active run"""
-    run_name = get_full_run_name(run_name)
+    # The run must already exist, which implies its algorithm was validated
+    # when it was initialised
+    run_name = get_full_run_name(run_name, validate_algorithm=False)
 
     if run_exists(run_name):
         # Set to active run
@@ -423,7 +554,7 @@ def run() -> None:
 
     try:
         logs = execute_datakit(
-            client,
+            get_docker_client(),
             run_name,
             base_path=DATAKIT_PATH,
         )
@@ -476,13 +607,7 @@ def show(
             base_path=DATAKIT_PATH,
         )
 
-        print(
-            tabulate(
-                resource.to_dict()["data"],
-                headers="keys",
-                tablefmt="rounded_grid",
-            )
-        )
+        print_resource(resource)
     else:
         # Variable is a simple string/number/bool value
         variable = load_variable(
@@ -491,13 +616,7 @@ def show(
             base_path=DATAKIT_PATH,
         )
 
-        print(
-            Panel(
-                str(variable["value"]),
-                title=f"{variable_name}",
-                expand=False,
-            )
-        )
+        print_value(variable_name, variable["value"])
 
 
 @app.command()
@@ -508,6 +627,14 @@ def view(
             help="The name of the view to render", show_default=False
         ),
     ],
+    static: Annotated[
+        bool,
+        typer.Option(
+            "--static",
+            "-s",
+            help="Save the view as a PNG image instead of opening a browser",
+        ),
+    ] = False,
 ) -> None:
     """Render a view locally"""
     run_name = get_active_run()
@@ -516,7 +643,7 @@ def view(
 
     try:
         logs = execute_view(
-            docker_client=client,
+            docker_client=get_docker_client(),
             run_name=run_name,
             view_name=view_name,
             base_path=DATAKIT_PATH,
@@ -546,17 +673,22 @@ def view(
         f"[bold]=>[/bold] Successfully generated [bold]{view_name}[/bold] view"
     )
 
-    print(
-        "[blue][bold]=>[/bold] Loading interactive view in web browser[/blue]"
+    view_artefacts_dir = VIEW_ARTEFACTS_DIR.format(
+        base_path=DATAKIT_PATH, run_name=run_name
     )
 
-    matplotlib.use("WebAgg")
+    # Plotting libraries are slow to import, so only load them when needed
+    import pickle
+    import matplotlib
+
+    # The backend must be selected before the figure is unpickled, as
+    # unpickling registers the figure with pyplot using the active backend.
+    # Agg renders headlessly without starting the WebAgg server
+    matplotlib.use("Agg" if static else "WebAgg")
 
-    with open(
-        VIEW_ARTEFACTS_DIR.format(base_path=DATAKIT_PATH, run_name=run_name)
-        + f"/{view_name}.p",
-        "rb",
-    ) as f:
+    import matplotlib.pyplot as plt
+
+    with open(os.path.join(view_artefacts_dir, f"{view_name}.p"), "rb") as f:
         # NOTE: The matplotlib version in CLI must be >= the version of
         # matplotlib used to generate the plot (which is chosen by the user)
         # So the CLI should be kept up to date at all times
@@ -564,7 +696,18 @@ def view(
         # Load matplotlib figure
         pickle.load(f)
 
-    plt.show()
+    if static:
+        # Save the figure registered with pyplot when it was unpickled, as
+        # the pickled object itself isn't necessarily a Figure
+        image_path = os.path.join(view_artefacts_dir, f"{view_name}.png")
+        plt.savefig(image_path)
+        print(f"[bold]=>[/bold] Saved view image: {image_path}")
+    else:
+        print(
+            "[blue][bold]=>[/bold] Loading interactive view in web browser"
+            "[/blue]"
+        )
+        plt.show()
 
 
 @app.command()
@@ -595,6 +738,8 @@ def load(
 
     # Read CSV into resource
     print(f"[bold]=>[/bold] Reading {path}")
+    import pandas as pd
+
     resource.data = pd.read_csv(path)
 
     # Write to resource
@@ -643,11 +788,7 @@ def set(
 
         # Check the variable_ref matches the pattern:
         # [resource].[primary key].[column]
-        pattern = re.compile(
-            r"^([a-zA-Z0-9_]+)\.([a-zA-Z0-9_]+)\.([a-zA-Z0-9_]+)$"
-        )
-
-        if not pattern.match(variable_ref):
+        if not TABLE_REF_PATTERN.match(variable_ref):
             print(
                 "[red]Variable name argument must be either a variable name "
                 "or a table reference in the format "
@@ -711,6 +852,8 @@ def set(
             f"[bold]{variable_value}[/bold] in resource [bold]{resource.name}"
             "[/bold]"
         )
+
+        print_resource(resource)
     else:
         # Variable reference is a simple variable name
         variable_name = variable_ref
@@ -763,17 +906,18 @@ def set(
         run = load_run_configuration(run_name, base_path=DATAKIT_PATH)
 
         # Set variable value
-        find_by_name(
-            run["data"]["inputs"] + run["data"]["outputs"], variable_name
-        )["value"] = variable_value
+        variable = index_variables(run)[variable_name]
+        variable["value"] = variable_value
 
         # Write configuration
         write_run_configuration(run, base_path=DATAKIT_PATH)
 
-        # Execute any relationships applied to this variable value
+        # Execute any relationships applied to this variable value, reusing
+        # the run configuration loaded above
         execute_relationship(
             run_name=run_name,
             variable_name=variable_name,
+            run_config=run,
         )
 
         print(
@@ -781,20 +925,37 @@ def set(
             "variable"
         )
 
-    show(variable_name)
+        print_value(variable_name, variable["value"])
 
 
 @app.command()
-def reset():
+def reset() -> None:
     """Reset datakit to clean state
 
     Removes all run outputs and resets configurations to default
     """
     # Remove all run directories
-    for f in os.scandir(DATAKIT_PATH):
-        if f.is_dir() and f.path.endswith(".run"):
-            print(f"[bold]=>[/bold] Deleting [bold]{f.name}[/bold]")
-            shutil.rmtree(f.path)
+    # Match relative to root_dir so the datakit path itself is never
+    # interpreted as a glob pattern
+    run_dirs = [
+        os.path.join(DATAKIT_PATH, name)
+        for name in glob.glob(
+            "*" + RUN_EXTENSION, root_dir=DATAKIT_PATH, include_hidden=True
+        )
+    ]
+    run_dirs = [path for path in run_dirs if os.path.isdir(path)]
+
+    for path in run_dirs:
+        run_name = os.path.basename(path)
+        print(f"[bold]=>[/bold] Deleting [bold]{run_name}[/bold]")
+
+    if run_dirs:
+        # Deletion is I/O bound, so remove run directories concurrently
+        max_workers = min(MAX_IO_WORKERS, len(run_dirs))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # Consume results so any deletion errors are raised here
+            list(executor.map(shutil.rmtree, run_dirs))
 
     # Remove all run references from datakit.json
     datakit = load_datakit_configuration(base_path=DATAKIT_PATH)
@@ -819,8 +980,8 @@ def new(
     """Generate a new datakit and algorithm scaffold"""
     # Create new datakit directory
     datakit_name = f"{algorithm_name}-datakit"
-    datakit_dir = f"{DATAKIT_PATH}/{datakit_name}"
-    algorithm_dir = f"{datakit_dir}/{algorithm_name}"
+    datakit_dir = os.path.join(DATAKIT_PATH, datakit_name)
+    algorithm_dir = os.path.join(datakit_dir, algorithm_name)
 
     if not os.path.exists(datakit_dir):
         os.makedirs(datakit_dir)
@@ -880,7 +1041,7 @@ def new(
 
     write_datakit_configuration(datakit, base_path=datakit_dir)
     write_algorithm(algorithm, base_path=datakit_dir)
-    with open(f"{datakit_dir}/{algorithm_name}/algorithm.py", "x") as f:
+    with open(os.path.join(algorithm_dir, "algorithm.py"), "x") as f:
         f.write(algorithm_code)
 
     print(f"[bold]=>[/bold] Successfully created [bold]{datakit_name}[/bold]")